@@ -1,33 +1,90 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_from_directory, g, has_request_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from flask_caching import Cache
+import orjson
 import os
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
-import uuid
-from datetime import datetime
+import secrets
+from datetime import datetime, timezone
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from yolov4 import detect_cars
 from algo import optimize_traffic
+import db
+
+class OrjsonProvider(JSONProvider):
+    """Serialize responses with orjson, which also handles datetimes and NumPy values."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache"})
 
 # Configuration
 UPLOAD_FOLDER = "uploads"
 ALLOWED_EXTENSIONS = {"mp4", "avi", "mov"}
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Copy uploads to disk 1 MiB at a time
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+app.config["MAX_CONTENT_LENGTH"] = 1024 * 1024 * 1024  # Reject uploads over 1 GiB (all 4 videos) with 413
+# Internal Nginx location mapped to UPLOAD_FOLDER; when set, Nginx sends the video bytes
+app.config["VIDEO_ACCEL_REDIRECT"] = os.environ.get("VIDEO_ACCEL_REDIRECT")
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
-# In-memory store (replace with database in production)
-activities = []
-recent_activities = []  # Store recent actions
-users = set()  # Track unique user IDs
+# Activities, the recent-activity log and users are persisted in SQLite
+db.init_db()
+
+# Cache keys of the polled views, cleared whenever the data behind them changes
+REPORTS_CACHE_KEY = "reports"
+DASHBOARD_STATS_CACHE_KEY = "dashboard_stats"
+CACHE_TIMEOUT = 2  # seconds
+
+# Approvals are processed in the background so /approve returns immediately
+job_executor = ThreadPoolExecutor(max_workers=2)
+
+# Long-lived pool so the four direction videos are processed concurrently and
+# each thread keeps its detector state between approvals
+detection_executor = ThreadPoolExecutor(max_workers=4)
 
 def allowed_file(filename):
     """Check if the file extension is allowed."""
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def now():
+    """Current UTC time, computed once per request."""
+    if not has_request_context():
+        return datetime.now(timezone.utc)
+    if "now" not in g:
+        g.now = datetime.now(timezone.utc)
+    return g.now
+
+def invalidate_views(*keys):
+    """Drop cached responses of views whose data has changed."""
+    with app.app_context():
+        cache.delete_many(*keys)
+
+def save_upload(file_storage, path):
+    """Stream an uploaded file to disk in fixed-size chunks so memory use stays flat."""
+    with open(path, "wb") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        shutil.copyfileobj(file_storage.stream, f, length=UPLOAD_CHUNK_SIZE)
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    """Report uploads over MAX_CONTENT_LENGTH as JSON like the other errors."""
+    return jsonify({"error": "Upload too large"}), 413
+
 @app.route("/")
 def home():
     return jsonify({"message": "Server is running!"}), 200
@@ -44,7 +101,7 @@ def upload_files():
     if len(videos) != 4:
         return jsonify({"error": "Exactly 4 videos are required"}), 400
 
-    activity_id = str(uuid.uuid4())
+    activity_id = secrets.token_hex(16)
     activity_folder = os.path.join(app.config["UPLOAD_FOLDER"], activity_id)
     os.makedirs(activity_folder)
 
@@ -54,149 +111,162 @@ def upload_files():
         if video and allowed_file(video.filename):
             filename = secure_filename(f"{directions[i]}.mp4")
             video_path = os.path.join(activity_folder, filename)
-            video.save(video_path)
+            save_upload(video, video_path)
             video_urls.append(f"http://localhost:5000/videos/{activity_id}/{filename}")
         else:
             shutil.rmtree(activity_folder)
             return jsonify({"error": "Invalid video file"}), 400
 
     # Track user
-    users.add(user_id)
+    db.add_user(user_id)
 
     # Create activity
     activity = {
         "id": activity_id,
         "userId": user_id,
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": now(),
         "videos": video_urls,
         "status": "pending",
         "result": None,
         "trafficCounts": None  # Initialize for later use
     }
-    activities.append(activity)
+    db.add_activity(activity)
 
     # Log recent activity
-    recent_activities.append({
-        "id": str(uuid.uuid4()),
-        "action": f"User '{user_id}' uploaded videos",
-        "timestamp": datetime.utcnow().isoformat()
-    })
+    db.log_recent_activity(f"User '{user_id}' uploaded videos", now())
+    invalidate_views(DASHBOARD_STATS_CACHE_KEY)
 
     return jsonify({"activityId": activity_id}), 201
 
 @app.route("/activities", methods=["GET"])
 def get_activities():
     """Return list of pending activities."""
-    pending_activities = [activity for activity in activities if activity["status"] == "pending"]
+    pending_activities = db.activities_with_status("pending")
     return jsonify(pending_activities), 200
 
+def process_activity(activity_id, video_paths):
+    """Run YOLOv4 and the traffic optimization for an approved activity."""
+    try:
+        num_cars_list = list(detection_executor.map(detect_cars, video_paths))
+        result = optimize_traffic(num_cars_list)
+    except Exception as e:
+        print(f"Error processing activity '{activity_id}': {e}")
+
+        # Put it back in the pending list so it can be approved again or rejected
+        activity = db.update_status(activity_id, "pending", "processing")
+        if activity is not None:
+            db.log_recent_activity(f"Processing failed for activity '{activity_id}' of user '{activity['userId']}'", now())
+        invalidate_views(DASHBOARD_STATS_CACHE_KEY)
+        return
+
+    # Update activity with results and traffic counts
+    activity = db.complete_activity(activity_id, result, {
+        "north": num_cars_list[0],
+        "south": num_cars_list[1],
+        "east": num_cars_list[2],
+        "west": num_cars_list[3]
+    })
+
+    # Log recent activity
+    db.log_recent_activity(f"Admin approved activity '{activity_id}' for user '{activity['userId']}'", now())
+    invalidate_views(REPORTS_CACHE_KEY)
+
 @app.route("/activities/<activity_id>/approve", methods=["POST"])
 def approve_activity(activity_id):
-    """Approve an activity and process videos with YOLOv4 and optimization."""
-    for activity in activities:
-        if activity["id"] == activity_id and activity["status"] == "pending":
-            video_paths = [
-                os.path.join(app.config["UPLOAD_FOLDER"], activity_id, f"{direction}.mp4")
-                for direction in ["north", "south", "east", "west"]
-            ]
-            num_cars_list = [detect_cars(video) for video in video_paths]
-            result = optimize_traffic(num_cars_list)
-
-            # Update activity with results and traffic counts
-            activity["status"] = "approved"
-            activity["result"] = result
-            activity["trafficCounts"] = {
-                "north": num_cars_list[0],
-                "south": num_cars_list[1],
-                "east": num_cars_list[2],
-                "west": num_cars_list[3]
-            }
-
-            # Log recent activity
-            recent_activities.append({
-                "id": str(uuid.uuid4()),
-                "action": f"Admin approved activity '{activity_id}' for user '{activity['userId']}'",
-                "timestamp": datetime.utcnow().isoformat()
-            })
-
-            return jsonify({"success": True}), 200
-    return jsonify({"error": "Activity not found or already processed"}), 404
+    """Approve an activity and queue its videos for YOLOv4 and optimization.
+
+    Poll /results/<activity_id> until the status changes from "processing"; it
+    returns to "pending" if processing failed.
+    """
+    # The job runs in this process, so record it as the owner
+    if not db.start_processing(activity_id, os.getpid()):
+        return jsonify({"error": "Activity not found or already processed"}), 404
+    invalidate_views(DASHBOARD_STATS_CACHE_KEY)
+
+    video_paths = [
+        os.path.join(app.config["UPLOAD_FOLDER"], activity_id, f"{direction}.mp4")
+        for direction in ["north", "south", "east", "west"]
+    ]
+    job_executor.submit(process_activity, activity_id, video_paths)
+
+    return jsonify({"success": True, "activityId": activity_id}), 202
 
 @app.route("/activities/<activity_id>/reject", methods=["POST"])
 def reject_activity(activity_id):
     """Reject an activity."""
-    for activity in activities:
-        if activity["id"] == activity_id and activity["status"] == "pending":
-            activity["status"] = "rejected"
+    activity = db.update_status(activity_id, "rejected", "pending")
+    if activity is None:
+        return jsonify({"error": "Activity not found or already processed"}), 404
 
-            # Log recent activity
-            recent_activities.append({
-                "id": str(uuid.uuid4()),
-                "action": f"Admin rejected activity '{activity_id}' for user '{activity['userId']}'",
-                "timestamp": datetime.utcnow().isoformat()
-            })
+    # Log recent activity
+    db.log_recent_activity(f"Admin rejected activity '{activity_id}' for user '{activity['userId']}'", now())
+    invalidate_views(DASHBOARD_STATS_CACHE_KEY)
 
-            return jsonify({"success": True}), 200
-    return jsonify({"error": "Activity not found or already processed"}), 404
+    return jsonify({"success": True}), 200
 
 @app.route("/results/<activity_id>", methods=["GET"])
 def get_results(activity_id):
     """Return status and results for an activity."""
-    for activity in activities:
-        if activity["id"] == activity_id:
-            response = {"status": activity["status"]}
-            if activity["status"] == "approved" and activity["result"]:
-                response["result"] = activity["result"]
-            return jsonify(response), 200
-    return jsonify({"error": "Activity not found"}), 404
+    activity = db.get_activity(activity_id)
+    if activity is None:
+        return jsonify({"error": "Activity not found"}), 404
+
+    response = {"status": activity["status"]}
+    if activity["status"] == "approved" and activity["result"]:
+        response["result"] = activity["result"]
+    return jsonify(response), 200
 
 @app.route("/videos/<activity_id>/<filename>", methods=["GET"])
 def serve_video(activity_id, filename):
-    """Serve video files."""
-    video_path = os.path.join(app.config["UPLOAD_FOLDER"], activity_id, filename)
-    if os.path.exists(video_path):
-        return send_file(video_path)
-    return jsonify({"error": "Video not found"}), 404
+    """Serve video files, honouring Range and conditional requests so players can seek."""
+    upload_folder = os.path.abspath(app.config["UPLOAD_FOLDER"])
+    video_path = f"{activity_id}/{filename}"
+
+    accel_redirect = app.config["VIDEO_ACCEL_REDIRECT"]
+    if accel_redirect:
+        file_path = safe_join(upload_folder, video_path)
+        if file_path is None or not os.path.isfile(file_path):
+            return jsonify({"error": "Video not found"}), 404
+        response = app.response_class(mimetype="video/mp4")
+        response.headers["X-Accel-Redirect"] = f"{accel_redirect.rstrip('/')}/{video_path}"
+        return response
+
+    try:
+        return send_from_directory(upload_folder, video_path, conditional=True)
+    except NotFound:
+        return jsonify({"error": "Video not found"}), 404
 
 @app.route("/dashboard/stats", methods=["GET"])
+@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=DASHBOARD_STATS_CACHE_KEY)
 def get_dashboard_stats():
     """Return dashboard statistics."""
     return jsonify({
-        "totalUsers": len(users),
+        "totalUsers": db.count_users(),
         "activeSessions": 0,  # Implement session tracking if needed
-        "pendingTasks": len([a for a in activities if a["status"] == "pending"]),
+        "pendingTasks": db.count_with_status("pending"),
         "systemStatus": "Operational"  # Add health check logic if needed
     }), 200
 
 @app.route("/dashboard/recent-activity", methods=["GET"])
 def get_recent_activity():
     """Return last 10 recent activities, sorted by timestamp (newest first)."""
-    sorted_activities = sorted(recent_activities, key=lambda x: x["timestamp"], reverse=True)[:10]
-    return jsonify(sorted_activities), 200
+    return jsonify(db.recent_activities(10)), 200
 
 @app.route("/reports", methods=["GET"])
+@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=REPORTS_CACHE_KEY)
 def get_reports():
     """Return all approved activities with results and traffic counts for reporting."""
-    approved_activities = [
-        {
-            "id": activity["id"],
-            "userId": activity["userId"],
-            "timestamp": activity["timestamp"],
-            "trafficCounts": activity.get("trafficCounts", {
-                "north": 0,
-                "south": 0,
-                "east": 0,
-                "west": 0
-            }),
-            "signalTimings": activity["result"]
-        }
-        for activity in activities
-        if activity["status"] == "approved" and activity["result"]
-    ]
-    return jsonify({
-        "totalProcessed": len(approved_activities),
-        "reports": approved_activities
-    }), 200
+    # Each report was serialized once at approval, so the response is just joined
+    reports = db.approved_reports()
+    body = '{"totalProcessed": %d, "reports": [%s]}' % (len(reports), ", ".join(reports))
+    return app.response_class(body, status=200, mimetype="application/json")
+
+@app.cli.command("requeue-jobs")
+def requeue_jobs_command():
+    """Requeue activities left "processing" by a stopped server; run it before starting one."""
+    print(f"Requeued {db.requeue_jobs()} activities")
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    # Development server only; run gunicorn -c gunicorn.conf.py app:app in production
+    db.requeue_jobs()
+    app.run(host="0.0.0.0", port=5000, debug=os.environ.get("FLASK_DEBUG") == "1")
\ No newline at end of file
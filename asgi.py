@@ -0,0 +1,18 @@
+# ASGI entry point: uvicorn asgi:asgi_app --host 0.0.0.0 --port 5000 --workers 4
+#
+# Uvicorn has no hook for requeueing approvals interrupted by a stop or a
+# worker crash, so run "flask --app app requeue-jobs" before starting it.
+#
+# Uvicorn's event loop holds the client connections, so many clients can keep
+# polling the read endpoints without each one tying up a server thread. a2wsgi
+# runs the Flask views on a pool of ASGI_THREADS threads, so a slow upload does
+# not hold up other requests, and it streams the request body to Flask as it
+# arrives, so oversized uploads are still rejected with 413 before they are
+# read. /approve hands the YOLO work to the job executor.
+import os
+
+from a2wsgi import WSGIMiddleware
+
+from app import app
+
+asgi_app = WSGIMiddleware(app, workers=int(os.environ.get("ASGI_THREADS", "8")))
@@ -0,0 +1,289 @@
+"""SQLite store for activities, the recent-activity log and users.
+
+Each thread keeps its own connection. The database runs in WAL mode, so
+readers never block the writer and several gunicorn workers can share it.
+TIMESTAMP columns are stored as ISO 8601 text and read back as datetimes;
+JSON columns are encoded with orjson.
+"""
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import orjson
+
+DATABASE = os.environ.get("DATABASE", "traffic.db")
+RECENT_ACTIVITY_LIMIT = 1000  # Older log entries are deleted
+CACHE_SIZE = 256  # Finished activities kept in memory
+
+# Approved and rejected activities never change again, so they can be cached
+FINAL_STATUSES = ("approved", "rejected")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activities (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    ts TIMESTAMP NOT NULL,
+    videos TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    counts TEXT,
+    report TEXT,
+    worker INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_status ON activities(status);
+
+CREATE TABLE IF NOT EXISTS recent_activities (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    action TEXT NOT NULL,
+    ts TIMESTAMP NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY
+);
+"""
+
+ACTIVITY_COLUMNS = "id, user_id, ts, videos, status, result, counts"
+
+_local = threading.local()
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+sqlite3.register_adapter(datetime, datetime.isoformat)
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+
+
+def _dumps(obj):
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+
+def _connect():
+    conn = sqlite3.connect(DATABASE, timeout=5, detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def get_db():
+    """Return the calling thread's connection, opening it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    return conn
+
+
+def init_db():
+    """Create the tables and indexes if they do not exist yet."""
+    # Use a throwaway connection so no connection is inherited by forked workers
+    conn = _connect()
+    try:
+        conn.executescript(SCHEMA)
+    finally:
+        conn.close()
+
+
+def requeue_jobs(worker=None):
+    """Put activities whose background job was lost back to "pending".
+
+    With worker (a process id), only the jobs that process claimed are
+    requeued, e.g. after it crashed. Without it every "processing" activity
+    is, which is only safe while no server process is running. Returns the
+    number of activities requeued.
+    """
+    # Called from the gunicorn master, so no per-thread connection is opened
+    conn = _connect()
+    try:
+        with conn:
+            if worker is None:
+                cursor = conn.execute("UPDATE activities SET status = 'pending' WHERE status = 'processing'")
+            else:
+                cursor = conn.execute(
+                    "UPDATE activities SET status = 'pending' WHERE status = 'processing' AND worker = ?",
+                    (worker,)
+                )
+        return cursor.rowcount
+    finally:
+        conn.close()
+
+
+def _row_to_activity(row):
+    activity_id, user_id, timestamp, videos, status, result, counts = row
+    return {
+        "id": activity_id,
+        "userId": user_id,
+        "timestamp": timestamp,
+        "videos": orjson.loads(videos),
+        "status": status,
+        "result": orjson.loads(result) if result else None,
+        "trafficCounts": orjson.loads(counts) if counts else None
+    }
+
+
+def make_report(activity):
+    """Shape of an approved activity in /reports."""
+    return {
+        "id": activity["id"],
+        "userId": activity["userId"],
+        "timestamp": activity["timestamp"],
+        "trafficCounts": activity["trafficCounts"] or {
+            "north": 0,
+            "south": 0,
+            "east": 0,
+            "west": 0
+        },
+        "signalTimings": activity["result"]
+    }
+
+
+def _cache_put(activity):
+    if activity["status"] not in FINAL_STATUSES:
+        return
+    with _cache_lock:
+        _cache[activity["id"]] = activity
+        _cache.move_to_end(activity["id"])
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _cache_get(activity_id):
+    with _cache_lock:
+        activity = _cache.get(activity_id)
+        if activity is not None:
+            _cache.move_to_end(activity_id)
+        return activity
+
+
+def add_user(user_id):
+    with get_db() as conn:
+        conn.execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (user_id,))
+
+
+def count_users():
+    return get_db().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+
+def add_activity(activity):
+    with get_db() as conn:
+        conn.execute(
+            f"INSERT INTO activities ({ACTIVITY_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                activity["id"],
+                activity["userId"],
+                activity["timestamp"],
+                _dumps(activity["videos"]),
+                activity["status"],
+                _dumps(activity["result"]) if activity["result"] else None,
+                _dumps(activity["trafficCounts"]) if activity["trafficCounts"] else None
+            )
+        )
+
+
+def get_activity(activity_id):
+    """Return the activity with the given id, or None."""
+    activity = _cache_get(activity_id)
+    if activity is not None:
+        return activity
+
+    row = get_db().execute(
+        f"SELECT {ACTIVITY_COLUMNS} FROM activities WHERE id = ?", (activity_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    activity = _row_to_activity(row)
+    _cache_put(activity)
+    return activity
+
+
+def activities_with_status(status):
+    """Return all activities with the given status in upload order."""
+    rows = get_db().execute(
+        f"SELECT {ACTIVITY_COLUMNS} FROM activities WHERE status = ? ORDER BY rowid", (status,)
+    ).fetchall()
+    return [_row_to_activity(row) for row in rows]
+
+
+def count_with_status(status):
+    return get_db().execute("SELECT COUNT(*) FROM activities WHERE status = ?", (status,)).fetchone()[0]
+
+
+def update_status(activity_id, status, expected_status):
+    """Move an activity from expected_status to status.
+
+    Returns the updated activity, or None if it does not exist or is no longer
+    in expected_status. The check and update are one statement, so two workers
+    cannot both claim the same activity.
+    """
+    with get_db() as conn:
+        updated = conn.execute(
+            "UPDATE activities SET status = ? WHERE id = ? AND status = ?",
+            (status, activity_id, expected_status)
+        ).rowcount
+        if not updated:
+            return None
+        row = conn.execute(
+            f"SELECT {ACTIVITY_COLUMNS} FROM activities WHERE id = ?", (activity_id,)
+        ).fetchone()
+
+    activity = _row_to_activity(row)
+    _cache_put(activity)
+    return activity
+
+
+def start_processing(activity_id, worker):
+    """Move a pending activity to "processing", owned by the given process id.
+
+    Returns False if it does not exist or is no longer pending.
+    """
+    with get_db() as conn:
+        return conn.execute(
+            "UPDATE activities SET status = 'processing', worker = ? WHERE id = ? AND status = 'pending'",
+            (worker, activity_id)
+        ).rowcount > 0
+
+
+def complete_activity(activity_id, result, traffic_counts):
+    """Store the results of an approved activity, with its serialized report, and mark it approved."""
+    with get_db() as conn:
+        row = conn.execute(
+            f"SELECT {ACTIVITY_COLUMNS} FROM activities WHERE id = ?", (activity_id,)
+        ).fetchone()
+        activity = _row_to_activity(row)
+        activity["status"] = "approved"
+        activity["result"] = result
+        activity["trafficCounts"] = traffic_counts
+
+        conn.execute(
+            "UPDATE activities SET status = 'approved', result = ?, counts = ?, report = ? WHERE id = ?",
+            (_dumps(result), _dumps(traffic_counts), _dumps(make_report(activity)), activity_id)
+        )
+
+    _cache_put(activity)
+    return activity
+
+
+def approved_reports():
+    """Return the precomputed JSON report of every approved activity in upload order."""
+    rows = get_db().execute(
+        "SELECT report FROM activities WHERE status = 'approved' ORDER BY rowid"
+    ).fetchall()
+    return [report for report, in rows]
+
+
+def log_recent_activity(action, timestamp):
+    """Append an entry to the log; its id is the monotonically increasing seq."""
+    with get_db() as conn:
+        seq = conn.execute(
+            "INSERT INTO recent_activities (action, ts) VALUES (?, ?)", (action, timestamp)
+        ).lastrowid
+        conn.execute("DELETE FROM recent_activities WHERE seq <= ?", (seq - RECENT_ACTIVITY_LIMIT,))
+    return seq
+
+
+def recent_activities(limit):
+    """Return the latest log entries, newest first."""
+    rows = get_db().execute(
+        "SELECT seq, action, ts FROM recent_activities ORDER BY seq DESC LIMIT ?", (limit,)
+    ).fetchall()
+    return [{"id": seq, "action": action, "timestamp": timestamp} for seq, action, timestamp in rows]
@@ -0,0 +1,36 @@
+# Production server settings: gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+
+# State lives in SQLite, so any worker can answer any request. Each worker that
+# processes an approval loads its own copy of the YOLO model.
+workers = int(os.environ.get("GUNICORN_WORKERS", "4"))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+# Import the app once in the master. The YOLO model and CUDA context are only
+# created on first use inside a worker, so nothing GPU-related is forked.
+preload_app = True
+
+# /approve returns straight away, but uploads of four videos can be slow
+timeout = 120
+
+
+def on_starting(server):
+    """Requeue approvals interrupted when the server last stopped; no worker is running yet."""
+    import db
+
+    db.init_db()
+    requeued = db.requeue_jobs()
+    if requeued:
+        server.log.info("Requeued %d interrupted activities", requeued)
+
+
+def child_exit(server, worker):
+    """Requeue the approvals of a worker that exited, e.g. after a crash or timeout."""
+    import db
+
+    requeued = db.requeue_jobs(worker.pid)
+    if requeued:
+        server.log.warning("Requeued %d activities of worker %s", requeued, worker.pid)
@@ -1,85 +1,371 @@
 import cv2 as cv
+import queue
+import threading
 import time
-from collections import deque
 import numpy as np
-from scipy.signal import find_peaks
+from yolov4_trt import MAX_BATCH, get_trt_detector
 
-def detect_cars(video_file):
-    try:
-        # Set thresholds
-        Conf_threshold = 0.4
-        NMS_threshold = 0.4
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Number of frames submitted to the detector per forward pass; the TensorRT
+# buffers and optimization profile are sized for this many frames
+BATCH = MAX_BATCH
+
+# Maximum number of decoded frames buffered between the reader and the detector
+PREFETCH = 2 * BATCH
+
+# Only every STRIDE-th frame is decoded and detected; counts change far slower than 30 fps
+STRIDE = 5
+
+# Frames whose thumbnail differs from the last detected frame by less than this
+# (mean absolute grey level) are skipped, since a repeated count cannot form a peak
+MOTION_THRESHOLD = 2.0
+MOTION_THUMBNAIL_SIZE = (64, 36)
+
+# Network input size
+INPUT_SIZE = (416, 416)
+
+# Model state shared by every detect_cars call, loaded once by _ensure_model()
+# and, for threads without a TensorRT detector, _ensure_net()
+class_name = None
+CAR_ID = None
+net = None
+_model_lock = threading.Lock()
+
+# cv.dnn.Net is not thread-safe, so concurrent calls take turns on forward()
+_net_lock = threading.Lock()
+
+def _ensure_model():
+    """Load the class names once."""
+    global class_name, CAR_ID
+
+    if class_name is not None:
+        return
+
+    with _model_lock:
+        if class_name is not None:
+            return
 
         # Load class names from file
-        class_name = []
         with open('classes.txt', 'r') as f:
-            class_name = [cname.strip() for cname in f.readlines()]
+            names = [cname.strip() for cname in f.readlines()]
 
-        if "car" not in class_name:
+        if "car" not in names:
             raise ValueError("Class 'car' not found in classes.txt")
 
+        CAR_ID = names.index("car")
+        class_name = names  # set last, it marks the names as loaded
+
+def _ensure_net():
+    """Load the OpenCV net once; only needed when TensorRT cannot be used."""
+    global net
+
+    if net is not None:
+        return
+
+    with _model_lock:
+        if net is not None:
+            return
+
         # Load the YOLO model
-        net = cv.dnn.readNet('yolov4-tiny.weights', 'yolov4-tiny.cfg')
+        model = cv.dnn.readNet('yolov4-tiny.weights', 'yolov4-tiny.cfg')
 
         # Check if CUDA is available, otherwise use CPU
         try:
-            net.setPreferableBackend(cv.dnn.DNN_BACKEND_CUDA)
-            net.setPreferableTarget(cv.dnn.DNN_TARGET_CUDA_FP16)
+            model.setPreferableBackend(cv.dnn.DNN_BACKEND_CUDA)
+            model.setPreferableTarget(cv.dnn.DNN_TARGET_CUDA_FP16)
         except:
-            net.setPreferableBackend(cv.dnn.DNN_BACKEND_DEFAULT)
-            net.setPreferableTarget(cv.dnn.DNN_TARGET_CPU)
+            model.setPreferableBackend(cv.dnn.DNN_BACKEND_DEFAULT)
+            model.setPreferableTarget(cv.dnn.DNN_TARGET_CPU)
+
+        net = model
+
+class GpuVideoReader:
+    """NVDEC-backed cv.cudacodec reader with the grab/retrieve interface of cv.VideoCapture.
+
+    Decoded frames stay on the GPU as cv.cuda_GpuMat instead of being decoded
+    by FFmpeg on the CPU.
+    """
+
+    def __init__(self, video_file):
+        self.reader = cv.cudacodec.createVideoReader(video_file)
+        self.reader.set(cv.cudacodec.ColorFormat_BGR)
+
+    def isOpened(self):
+        return self.reader is not None
+
+    def grab(self):
+        return self.reader.grab()
+
+    def retrieve(self):
+        return self.reader.retrieve()
+
+    def release(self):
+        self.reader = None
+
+def open_video(video_file):
+    """Open video_file for hardware decoding when OpenCV has CUDA support, else on the CPU."""
+    if hasattr(cv, "cudacodec") and cv.cuda.getCudaEnabledDeviceCount() > 0:
+        try:
+            return GpuVideoReader(video_file)
+        except cv.error as e:
+            print(f"Hardware decoding unavailable for {video_file}, using cv.VideoCapture: {e}")
+    return cv.VideoCapture(video_file)
+
+def make_thumbnail(frame):
+    """Small greyscale copy of a frame for the motion gate."""
+    if isinstance(frame, cv.cuda_GpuMat):
+        small = cv.cuda.resize(frame, MOTION_THUMBNAIL_SIZE, interpolation=cv.INTER_AREA)
+        return cv.cuda.cvtColor(small, cv.COLOR_BGR2GRAY).download()
+    small = cv.resize(frame, MOTION_THUMBNAIL_SIZE, interpolation=cv.INTER_AREA)
+    return cv.cvtColor(small, cv.COLOR_BGR2GRAY)
+
+def put_until_stopped(frame_queue, item, stop):
+    """Put item on frame_queue, giving up if the consumer has stopped."""
+    while not stop.is_set():
+        try:
+            frame_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def read_frames(cap, frame_queue, stop, gpu_pool=None):
+    """Decode frames into frame_queue until EOF or stop is set, then put a None sentinel.
+
+    If decoding fails, the exception is put on the queue instead of the
+    sentinel so the consumer can raise it rather than count a truncated video.
+
+    GPU-decoded frames are resized to network size on the GPU and downloaded.
+    With gpu_pool, a queue of GpuMats the consumer is done with, they are instead
+    copied at full size into a pooled GpuMat, which the TensorRT preprocessing
+    kernel resizes itself.
+    """
+    last_thumbnail = None
+    frame_index = 0
+    end = None
+    try:
+        while not stop.is_set():
+            # grab() skips the decode to BGR, so strided-over frames stay cheap
+            if not cap.grab():
+                break
+            frame_index += 1
+            if (frame_index - 1) % STRIDE:
+                continue
+
+            ret, frame = cap.retrieve()
+            if not ret:
+                break
+
+            # Skip frames with no motion since the last frame sent to the detector
+            thumbnail = make_thumbnail(frame)
+            if last_thumbnail is not None and cv.absdiff(thumbnail, last_thumbnail).mean() < MOTION_THRESHOLD:
+                continue
+            last_thumbnail = thumbnail
+
+            # retrieve() returns the reader's own buffer, which the next grab()
+            # decodes over, so GPU frames are always copied before being queued
+            if isinstance(frame, cv.cuda_GpuMat):
+                if gpu_pool is not None:
+                    try:
+                        buffer = gpu_pool.get_nowait()
+                    except queue.Empty:
+                        buffer = cv.cuda_GpuMat()
+                    frame = frame.copyTo(buffer)
+                else:
+                    # Resize on the GPU so only the network-sized frame is copied back
+                    frame = cv.cuda.resize(frame, INPUT_SIZE).download()
+
+            if not put_until_stopped(frame_queue, frame, stop):
+                break
+    except Exception as e:
+        end = e
+    finally:
+        put_until_stopped(frame_queue, end, stop)
+
+def car_candidates_numpy(rows, car_id, conf_threshold):
+    """Mask of detection rows whose best class is car, and each row's best class score."""
+    scores = rows[:, 5:]
+    class_ids = np.argmax(scores, axis=1)
+    confidences = scores[np.arange(len(rows)), class_ids]
+    keep = (rows[:, 4] >= conf_threshold) & (class_ids == car_id) & (confidences >= conf_threshold)
+    return keep, confidences
+
+def car_candidates_loop(rows, car_id, conf_threshold):
+    """Single-pass version of car_candidates_numpy for Numba, without temporary arrays."""
+    n = rows.shape[0]
+    keep = np.zeros(n, dtype=np.bool_)
+    confidences = np.zeros(n, dtype=np.float32)
+    for i in range(n):
+        if rows[i, 4] < conf_threshold:
+            continue
+        best = 5
+        for j in range(6, rows.shape[1]):
+            if rows[i, j] > rows[i, best]:
+                best = j
+        confidences[i] = rows[i, best]
+        keep[i] = best - 5 == car_id and rows[i, best] >= conf_threshold
+    return keep, confidences
+
+def accumulate_peaks(counts, prev, rising, peak_sum, peak_n):
+    """Advance the PeakTracker state over counts; prev is -1 before the first sample."""
+    for i in range(counts.shape[0]):
+        count = counts[i]
+        if prev >= 0:
+            if count > prev:
+                rising = True
+            elif count < prev:
+                if rising:
+                    peak_sum += prev
+                    peak_n += 1
+                rising = False
+        prev = count
+    return prev, rising, peak_sum, peak_n
+
+# Compile the per-frame loops when Numba is installed; the NumPy version is
+# faster than an interpreted loop for the candidate filter
+if njit is not None:
+    car_candidates = njit(cache=True)(car_candidates_loop)
+    accumulate_peaks = njit(cache=True)(accumulate_peaks)
+else:
+    car_candidates = car_candidates_numpy
+
+class PeakTracker:
+    """Streaming equivalent of scipy.signal.find_peaks over a car count series.
+
+    A peak is a sample, or a flat run of samples, strictly higher than its
+    neighbours on both sides, so only the previous count and whether the series
+    has risen since the last drop need to be kept.
+    """
+
+    def __init__(self):
+        self.prev = -1
+        self.rising = False
+        self.peak_sum = 0
+        self.peak_n = 0
+
+    def update(self, counts):
+        self.prev, self.rising, self.peak_sum, self.peak_n = accumulate_peaks(
+            np.asarray(counts, dtype=np.int64), self.prev, self.rising, self.peak_sum, self.peak_n
+        )
+
+    def mean(self):
+        """Mean of the peak values seen so far, or 0 if there were none."""
+        return self.peak_sum / self.peak_n if self.peak_n else 0
 
-        # Initialize the detection model
-        model = cv.dnn_DetectionModel(net)
-        model.setInputParams(size=(416, 416), scale=1/255, swapRB=True)
+def count_cars_dnn(net, frames, car_id, conf_threshold, nms_threshold):
+    """Run one batched OpenCV DNN forward pass and return the car count per frame."""
+    blob = cv.dnn.blobFromImages(frames, 1/255, INPUT_SIZE, swapRB=True)
+    net.setInput(blob)
+    outs = net.forward(net.getUnconnectedOutLayersNames())
+
+    # Rows are [cx, cy, w, h, objectness, class scores...], grouped per image
+    detections = np.concatenate([out.reshape(len(frames), -1, out.shape[-1]) for out in outs], axis=1)
+
+    counts = []
+    for rows, frame in zip(detections, frames):
+        keep, confidences = car_candidates(np.ascontiguousarray(rows), car_id, conf_threshold)
+        if not keep.any():
+            counts.append(0)
+            continue
+
+        # Same integer pixel rects as cv.dnn_DetectionModel, so NMS keeps the same boxes
+        height, width = frame.shape[:2]
+        cx, cy, w, h = (rows[keep, :4] * np.float32([width, height, width, height])).astype(np.int32).T
+        left = np.clip(cx - w // 2, 0, width - 1)
+        top = np.clip(cy - h // 2, 0, height - 1)
+        w = np.clip(w, 1, width - left)
+        h = np.clip(h, 1, height - top)
+        boxes = np.stack([left, top, w, h], axis=1)
+
+        # NMS is class-wise, so only the car boxes need to be suppressed
+        indices = cv.dnn.NMSBoxes(boxes.tolist(), confidences[keep].tolist(), conf_threshold, nms_threshold)
+        counts.append(len(indices))
+    return np.array(counts)
+
+def detect_cars(video_file):
+    try:
+        # Set thresholds
+        Conf_threshold = 0.4
+        NMS_threshold = 0.4
+
+        _ensure_model()
+
+        # Prefer the TensorRT engine, fall back to the OpenCV DNN backend
+        detector = get_trt_detector()
+        if detector is None:
+            _ensure_net()
 
         # Open the video file
-        cap = cv.VideoCapture(video_file)
+        cap = open_video(video_file)
         if not cap.isOpened():
             raise FileNotFoundError(f"Error: Cannot open video file {video_file}")
 
         starting_time = time.time()
         frame_counter = 0
 
-        # To keep track of car counts over time
-        car_counts = deque()
+        # Track peaks in the car count over the whole video
+        car_peaks = PeakTracker()
 
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
+        # Frames waiting for the next batched forward pass
+        batch_frames = []
 
-            frame_counter += 1
+        def process_batch():
+            if detector is not None:
+                # NMS already ran on the GPU inside the engine
+                batch_counts = detector.count_cars(batch_frames, CAR_ID, Conf_threshold)
+            else:
+                with _net_lock:
+                    batch_counts = count_cars_dnn(net, batch_frames, CAR_ID, Conf_threshold, NMS_threshold)
 
-            # Perform detection
-            classes, scores, boxes = model.detect(frame, Conf_threshold, NMS_threshold)
+            car_peaks.update(batch_counts)
 
-            # Count the number of cars detected
-            car_count = sum(1 for classid in classes if class_name[classid] == "car")
+            # Inference has finished with the pooled GPU frames, so the reader can reuse them
+            if gpu_pool is not None:
+                for frame in batch_frames:
+                    if isinstance(frame, cv.cuda_GpuMat):
+                        gpu_pool.put(frame)
+            batch_frames.clear()
 
-            # Record the car count with the current timestamp
-            current_time = time.time()
-            car_counts.append((current_time, car_count))
+        # Decode on a background thread so it overlaps with inference; the
+        # bounded queue keeps memory flat if decoding runs ahead
+        frame_queue = queue.Queue(maxsize=PREFETCH)
+        stop = threading.Event()
 
-            # Remove counts older than 30 seconds
-            while car_counts and car_counts[0][0] < current_time - 30:
-                car_counts.popleft()
+        # The TensorRT detector reads GPU frames in place
+        gpu_pool = queue.SimpleQueue() if detector is not None else None
+        reader = threading.Thread(target=read_frames, args=(cap, frame_queue, stop, gpu_pool), daemon=True)
+        reader.start()
 
-        # Extract the car counts from the deque
-        car_count_values = [count for _, count in car_counts]
+        try:
+            while True:
+                frame = frame_queue.get()
+                if frame is None:
+                    break
+                if isinstance(frame, Exception):
+                    raise frame
 
-        # Find peaks in the car count values
-        peaks, _ = find_peaks(car_count_values)
+                frame_counter += 1
+                batch_frames.append(frame)
 
-        # Calculate the mean of the peak values
-        mean_peak_value = np.mean([car_count_values[i] for i in peaks]) if peaks.size > 0 else 0
+                if len(batch_frames) == BATCH:
+                    process_batch()
 
-        # Release resources
-        cap.release()
+            # Flush the last partial batch
+            if batch_frames:
+                process_batch()
+        finally:
+            # Release resources
+            stop.set()
+            reader.join()
+            cap.release()
 
-        return mean_peak_value
+        # Calculate the mean of the peak values
+        return car_peaks.mean()
 
     except Exception as e:
         print(f"Error in detect_cars: {e}")
         return -1  # Return -1 to indicate an error
-
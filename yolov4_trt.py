@@ -0,0 +1,390 @@
+"""TensorRT inference path for the yolov4-tiny detector.
+
+The engine is built once from ``yolov4-tiny.onnx`` (export the Darknet
+cfg/weights with darknet2onnx and append an EfficientNMS_TRT node so NMS runs
+on the GPU) and serialized to ``yolov4-tiny.engine``; later runs only
+deserialize it. The NMS IoU threshold is baked into the plugin at export time
+(use 0.4 to match detect_cars).
+
+With YOLO_TRT_INT8=1 the engine is instead built for INT8 (plus FP16) as
+``yolov4-tiny.int8.engine``, calibrated on frames sampled from the uploaded
+videos. The calibration scales are written to ``yolov4-tiny.calib.cache``;
+keep that file next to the weights so rebuilds skip calibration. Without the
+variable the FP16 engine is used. If the GPU has no fast INT8 support, a
+warning is printed and the FP16 engine is used instead.
+
+tensorrt (8.5 or newer, for the name-based tensor API) and pycuda are
+optional: when they are missing, no ONNX/engine file is present, or the
+engine or a thread's detector cannot be created, get_trt_detector() returns
+None and detect_cars keeps using the OpenCV DNN backend.
+"""
+import glob
+import os
+import threading
+from contextlib import contextmanager
+
+import cv2 as cv
+import numpy as np
+
+try:
+    import tensorrt as trt
+    import pycuda.driver as cuda
+    from pycuda.compiler import SourceModule
+except ImportError:
+    trt = None
+    cuda = None
+
+ONNX_FILE = "yolov4-tiny.onnx"
+ENGINE_FILE = "yolov4-tiny.engine"
+INT8_ENGINE_FILE = "yolov4-tiny.int8.engine"
+CALIBRATION_CACHE = "yolov4-tiny.calib.cache"
+CALIBRATION_VIDEOS = os.path.join("uploads", "**", "*.mp4")
+CALIBRATION_FRAMES = 500
+INPUT_SIZE = (416, 416)
+MIN_BATCH = 1
+OPT_BATCH = 8
+MAX_BATCH = 8
+WORKSPACE_SIZE = 1 << 30
+
+# Output tensor names produced by EfficientNMS_TRT
+NUM_DETECTIONS = "num_detections"
+DETECTION_SCORES = "detection_scores"
+DETECTION_CLASSES = "detection_classes"
+
+# One pass per output pixel: bilinear resize (OpenCV's INTER_LINEAR pixel
+# mapping), BGR -> RGB, scale by 1/255 and HWC -> CHW, written straight into
+# the engine's input tensor. Reads pitched 3- or 4-channel uint8 images, so a
+# full-size GpuMat from NVDEC is resized on the GPU without downloading it.
+# Frames decoded on the CPU are shrunk before upload to save transfer
+# bandwidth, so for them the resize is an identity.
+PREPROCESS_KERNEL = r"""
+extern "C" __global__ void preprocess(const unsigned char* src, int src_step, int src_w, int src_h,
+                                      int channels, float* dst, int dst_w, int dst_h)
+{
+    int x = blockIdx.x * blockDim.x + threadIdx.x;
+    int y = blockIdx.y * blockDim.y + threadIdx.y;
+    if (x >= dst_w || y >= dst_h)
+        return;
+
+    float sx = fminf(fmaxf((x + 0.5f) * src_w / dst_w - 0.5f, 0.0f), src_w - 1.0f);
+    float sy = fminf(fmaxf((y + 0.5f) * src_h / dst_h - 0.5f, 0.0f), src_h - 1.0f);
+    int x0 = (int)sx;
+    int y0 = (int)sy;
+    int x1 = min(x0 + 1, src_w - 1);
+    int y1 = min(y0 + 1, src_h - 1);
+    float ax = sx - x0;
+    float ay = sy - y0;
+
+    const unsigned char* row0 = src + y0 * src_step;
+    const unsigned char* row1 = src + y1 * src_step;
+    int plane = dst_w * dst_h;
+    for (int c = 0; c < 3; ++c) {
+        float top = (1.0f - ax) * row0[x0 * channels + c] + ax * row0[x1 * channels + c];
+        float bottom = (1.0f - ax) * row1[x0 * channels + c] + ax * row1[x1 * channels + c];
+        dst[(2 - c) * plane + y * dst_w + x] = ((1.0f - ay) * top + ay * bottom) * (1.0f / 255.0f);
+    }
+}
+"""
+PREPROCESS_BLOCK = (16, 16, 1)
+
+_lock = threading.Lock()
+_logger = None
+_cuda_ctx = None
+_engine = None
+_preprocess = None
+_unavailable = False
+
+# Execution contexts are not thread-safe, so each worker thread gets its own
+_local = threading.local()
+
+
+@contextmanager
+def _cuda_context():
+    """Make the device's primary CUDA context current for the calling thread."""
+    _cuda_ctx.push()
+    try:
+        yield
+    finally:
+        _cuda_ctx.pop()
+
+
+def sample_calibration_frames(count=CALIBRATION_FRAMES):
+    """Return about count network-sized frames spread evenly over the uploaded videos."""
+    videos = sorted(glob.glob(CALIBRATION_VIDEOS, recursive=True))
+    if not videos:
+        return []
+
+    # At most count videos are opened, picked evenly across the uploads
+    if len(videos) > count:
+        videos = [videos[i] for i in np.linspace(0, len(videos) - 1, count).astype(int)]
+
+    per_video = -(-count // len(videos))
+    frames = []
+    for video in videos:
+        cap = cv.VideoCapture(video)
+        total = int(cap.get(cv.CAP_PROP_FRAME_COUNT))
+        for index in np.linspace(0, max(total - 1, 0), per_video).astype(int):
+            cap.set(cv.CAP_PROP_POS_FRAMES, int(index))
+            ret, frame = cap.read()
+            if ret:
+                frames.append(cv.resize(frame, INPUT_SIZE))
+        cap.release()
+    return frames[:count]
+
+
+if trt is not None:
+    class FrameCalibrator(trt.IInt8EntropyCalibrator2):
+        """Feeds sampled video frames to TensorRT's INT8 entropy calibration."""
+
+        def __init__(self, cache_file):
+            trt.IInt8EntropyCalibrator2.__init__(self)
+            self.cache_file = cache_file
+            self.index = 0
+
+            # Frames are only needed when there is no cache to reuse
+            self.frames = [] if os.path.exists(cache_file) else sample_calibration_frames()
+            width, height = INPUT_SIZE
+            self.device_input = cuda.mem_alloc(OPT_BATCH * 3 * height * width * np.dtype(np.float32).itemsize)
+
+        def get_batch_size(self):
+            return OPT_BATCH
+
+        def get_batch(self, names):
+            if self.index + OPT_BATCH > len(self.frames):
+                return None
+            batch = self.frames[self.index:self.index + OPT_BATCH]
+            self.index += OPT_BATCH
+
+            # Same normalization as the preprocessing kernel
+            blob = cv.dnn.blobFromImages(batch, 1/255, INPUT_SIZE, swapRB=True)
+            cuda.memcpy_htod(self.device_input, np.ascontiguousarray(blob))
+            return [int(self.device_input)]
+
+        def read_calibration_cache(self):
+            if os.path.exists(self.cache_file):
+                with open(self.cache_file, "rb") as f:
+                    return f.read()
+            return None
+
+        def write_calibration_cache(self, cache):
+            with open(self.cache_file, "wb") as f:
+                f.write(cache)
+
+
+def _build_engine(onnx_file, engine_file, int8=False):
+    """Convert the ONNX model to a serialized FP16 (or INT8) engine with a dynamic batch profile."""
+    builder = trt.Builder(_logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, _logger)
+
+    with open(onnx_file, "rb") as f:
+        if not parser.parse(f.read()):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise RuntimeError(f"Failed to parse {onnx_file}: {'; '.join(errors)}")
+
+    config = builder.create_builder_config()
+    config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, WORKSPACE_SIZE)
+    if builder.platform_has_fast_fp16:
+        config.set_flag(trt.BuilderFlag.FP16)
+
+    # Dynamic batch dimension so callers can submit 1..MAX_BATCH frames at once
+    width, height = INPUT_SIZE
+    input_name = network.get_input(0).name
+    profile = builder.create_optimization_profile()
+    profile.set_shape(
+        input_name,
+        (MIN_BATCH, 3, height, width),
+        (OPT_BATCH, 3, height, width),
+        (MAX_BATCH, 3, height, width),
+    )
+    config.add_optimization_profile(profile)
+
+    if int8:
+        calibrator = FrameCalibrator(CALIBRATION_CACHE)
+        if not calibrator.frames and not os.path.exists(CALIBRATION_CACHE):
+            raise RuntimeError(f"No calibration frames found in {CALIBRATION_VIDEOS}")
+        config.set_flag(trt.BuilderFlag.INT8)
+        config.int8_calibrator = calibrator
+        config.set_calibration_profile(profile)
+
+    serialized = builder.build_serialized_network(network, config)
+    if serialized is None:
+        raise RuntimeError(f"Failed to build TensorRT engine from {onnx_file}")
+
+    with open(engine_file, "wb") as f:
+        f.write(serialized)
+    return serialized
+
+
+def _supports_int8():
+    """Whether the GPU has fast INT8 support; prints a warning if it does not."""
+    if trt.Builder(_logger).platform_has_fast_int8:
+        return True
+    print("YOLO_TRT_INT8 is set but the GPU has no fast INT8 support, using the FP16 engine")
+    return False
+
+
+def _load_engine():
+    """Deserialize the cached engine selected by YOLO_TRT_INT8, building it from ONNX on first use."""
+    int8 = os.environ.get("YOLO_TRT_INT8") == "1"
+    if int8 and not os.path.exists(INT8_ENGINE_FILE):
+        int8 = _supports_int8()
+
+    engine_file = INT8_ENGINE_FILE if int8 else ENGINE_FILE
+    if os.path.exists(engine_file):
+        with open(engine_file, "rb") as f:
+            serialized = f.read()
+    else:
+        serialized = _build_engine(ONNX_FILE, engine_file, int8=int8)
+
+    runtime = trt.Runtime(_logger)
+    engine = runtime.deserialize_cuda_engine(serialized)
+    if engine is None:
+        raise RuntimeError(f"Failed to deserialize {engine_file}")
+    return engine
+
+
+class TrtDetector:
+    """Execution context, CUDA stream and pre-allocated buffers for one worker thread."""
+
+    def __init__(self, engine):
+        self.context = engine.create_execution_context()
+        self.stream = cuda.Stream()
+        self.host = {}
+        self.device = {}
+        self.outputs = []
+
+        for i in range(engine.num_io_tensors):
+            name = engine.get_tensor_name(i)
+            shape = tuple(MAX_BATCH if dim < 0 else dim for dim in engine.get_tensor_shape(name))
+            dtype = trt.nptype(engine.get_tensor_dtype(name))
+
+            if engine.get_tensor_mode(name) == trt.TensorIOMode.INPUT:
+                # Filled on the device by the preprocessing kernel
+                self.input_name = name
+                self.device[name] = cuda.mem_alloc(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            else:
+                # Pinned host memory so the async copies can overlap with compute
+                self.host[name] = cuda.pagelocked_empty(shape, dtype)
+                self.device[name] = cuda.mem_alloc(self.host[name].nbytes)
+                self.outputs.append(name)
+            self.context.set_tensor_address(name, int(self.device[name]))
+
+        # Staging buffers for frames that were decoded on the CPU
+        width, height = INPUT_SIZE
+        self.host_frames = cuda.pagelocked_empty((MAX_BATCH, height, width, 3), np.uint8)
+        self.device_frames = cuda.mem_alloc(self.host_frames.nbytes)
+
+    def _preprocess(self, frames):
+        """Write the frames into the input tensor as a normalized RGB NCHW batch."""
+        width, height = INPUT_SIZE
+        frame_bytes = width * height * 3
+        input_bytes = frame_bytes * np.dtype(np.float32).itemsize
+
+        # (pointer, row step, width, height, channels) of each source image on the device
+        sources = []
+        host_frames = 0
+        for i, frame in enumerate(frames):
+            if isinstance(frame, cv.cuda_GpuMat):
+                sources.append((frame.cudaPtr(), frame.step, frame.cols, frame.rows, frame.channels()))
+            else:
+                # Shrink on the CPU first so only network-sized uint8 pixels are uploaded
+                if frame.shape[:2] != (height, width):
+                    frame = cv.resize(frame, INPUT_SIZE)
+                self.host_frames[i] = frame
+                sources.append((int(self.device_frames) + i * frame_bytes, width * 3, width, height, 3))
+                host_frames = i + 1
+
+        if host_frames:
+            cuda.memcpy_htod_async(self.device_frames, self.host_frames[:host_frames], self.stream)
+
+        grid = ((width + PREPROCESS_BLOCK[0] - 1) // PREPROCESS_BLOCK[0],
+                (height + PREPROCESS_BLOCK[1] - 1) // PREPROCESS_BLOCK[1])
+        input_ptr = int(self.device[self.input_name])
+        for i, (ptr, step, src_w, src_h, channels) in enumerate(sources):
+            _preprocess(
+                np.uintp(ptr), np.int32(step), np.int32(src_w), np.int32(src_h), np.int32(channels),
+                np.uintp(input_ptr + i * input_bytes), np.int32(width), np.int32(height),
+                block=PREPROCESS_BLOCK, grid=grid, stream=self.stream,
+            )
+
+    def infer(self, frames):
+        """Run the engine on a batch of BGR frames (NumPy arrays or GpuMats) and return its outputs."""
+        batch = len(frames)
+        width, height = INPUT_SIZE
+        with _cuda_context():
+            self.context.set_input_shape(self.input_name, (batch, 3, height, width))
+            self._preprocess(frames)
+
+            self.context.execute_async_v3(stream_handle=self.stream.handle)
+
+            for name in self.outputs:
+                cuda.memcpy_dtoh_async(self.host[name][:batch], self.device[name], self.stream)
+            self.stream.synchronize()
+
+            return {name: self.host[name][:batch].copy() for name in self.outputs}
+
+    def count_cars(self, frames, car_id, conf_threshold):
+        """Return the number of cars detected in each of the given BGR frames."""
+        outputs = self.infer(frames)
+
+        num_detections = outputs[NUM_DETECTIONS].reshape(-1, 1)
+        scores = outputs[DETECTION_SCORES]
+        classes = outputs[DETECTION_CLASSES]
+
+        # Only the first num_detections slots of each image are valid
+        valid = np.arange(classes.shape[1]) < num_detections
+        cars = valid & (classes == car_id) & (scores >= conf_threshold)
+        return np.count_nonzero(cars, axis=1)
+
+
+def _ensure_engine():
+    """Load the shared engine once; return False when TensorRT cannot be used."""
+    global _logger, _cuda_ctx, _engine, _preprocess, _unavailable
+
+    if _engine is not None or _unavailable:
+        return not _unavailable
+
+    with _lock:
+        if _engine is not None or _unavailable:
+            return not _unavailable
+
+        model_files = (INT8_ENGINE_FILE, ENGINE_FILE, ONNX_FILE)
+        if trt is None or not any(os.path.exists(path) for path in model_files):
+            _unavailable = True
+            return False
+
+        try:
+            cuda.init()
+            _cuda_ctx = cuda.Device(0).retain_primary_context()
+            _logger = trt.Logger(trt.Logger.WARNING)
+            trt.init_libnvinfer_plugins(_logger, "")  # registers EfficientNMS_TRT
+
+            with _cuda_context():
+                _preprocess = SourceModule(PREPROCESS_KERNEL, no_extern_c=True).get_function("preprocess")
+                _engine = _load_engine()
+        except Exception as e:
+            print(f"TensorRT unavailable, falling back to OpenCV DNN: {e}")
+            _unavailable = True
+
+        return _engine is not None
+
+
+def get_trt_detector():
+    """Return the calling thread's TrtDetector, or None when TensorRT cannot be used."""
+    global _unavailable
+
+    if not _ensure_engine():
+        return None
+
+    detector = getattr(_local, "detector", None)
+    if detector is None:
+        try:
+            with _cuda_context():
+                detector = TrtDetector(_engine)
+        except Exception as e:
+            print(f"TensorRT unavailable, falling back to OpenCV DNN: {e}")
+            _unavailable = True
+            return None
+        _local.detector = detector
+    return detector